@@ -1,51 +1,116 @@
 """Utilities for running HammerBlade in F1.
 """
 
-import boto3
+import concurrent.futures
 import enum
+import errno
+import hashlib
+import json
 import shlex
 import click
 import subprocess
+import sys
+import tempfile
+import threading
 import socket
+import selectors
 import time
 import os
+import random
+import re
 import logging
 import click_log
 from collections import namedtuple
-import tomlkit
 
 __version__ = '1.0.0'
 
 SSH_PORT = 22
 
-# The setup script to run on new images.
-SETUP_SCRIPT = os.path.join(os.path.dirname(__file__), 'setup.sh')
+# Options for all our ssh invocations. With connection multiplexing, the
+# first connection to a host becomes a master that subsequent ssh
+# invocations reuse, so they skip the TCP and key exchange handshakes.
+# Keepalives stop idle sessions (and masters) from being dropped.
+SSH_CONTROL_PATH = '~/.ssh/chazz-%C'
+SSH_OPTS = [
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPath={}'.format(SSH_CONTROL_PATH),
+    '-o', 'ControlPersist=60s',
+    '-o', 'ServerAliveInterval=30',
+]
 
 # Paths for the user configuration and the configuration defaults.
 CONFIG_PATH = os.path.expanduser('~/.config/chazz.toml')
 DEFAULT_PATH = os.path.join(os.path.dirname(__file__), 'config_default.toml')
 
+# The form of EC2 instance IDs, to tell them apart from metadata names.
+INSTANCE_ID_RE = re.compile(r'i-(?:[0-9a-f]{8}|[0-9a-f]{17})')
+
+# The file on instances that records when the setup script last ran.
+SETUP_MARKER = '~/.chazz-setup'
+
+# Saved state about recently used instances, which is reused for
+# `STATE_TTL` seconds.
+STATE_PATH = os.path.expanduser('~/.cache/chazz/state.json')
+STATE_TTL = 60
+_state_lock = threading.Lock()
+
+# The parts of EC2 instance descriptions that we actually use. We keep
+# just these when caching or saving instances.
+INSTANCE_FIELDS = ('InstanceId', 'ImageId', 'PublicDnsName', 'State', 'Tags')
+
 
 # Logger.
 log = logging.getLogger(__name__)
 click_log.basic_config(log)
 
+# Cached EC2 instance descriptions, as (timestamp, instances) pairs.
+# See `describe_instances`.
+CACHE_TTL = 60
+_instance_cache = {}
+
+# Resolved socket addresses for (host, port) pairs. See `test_connect`.
+_addr_cache = {}
+
+# EC2 clients by region, and a lock for creating them. See `make_ec2`.
+_ec2_clients = {}
+_ec2_lock = threading.Lock()
+
+# The results of a non-blocking `connect_ex` that mean the handshake is
+# still in progress. Windows reports WSAEWOULDBLOCK instead of EINPROGRESS.
+CONNECT_PENDING = {
+    errno.EINPROGRESS,
+    errno.EWOULDBLOCK,
+    errno.EAGAIN,
+    getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK),
+}
+
 
 # Configuration object.
-Config = namedtuple("Config", [
-    'ec2',  # Boto EC2 client object.
+_Config = namedtuple("Config", [
+    'region',  # AWS region name.
     'ami_ids',  # Mapping from version names to AMI IDs.
+    'ami_names',  # The reverse mapping, from AMI IDs to version names.
     'ami_default',  # Name of the image to boot, or None to disable creation.
-    'ssh_key',  # Path to the SSH private key file.
+    'ssh_key',  # Absolute path to the SSH private key file.
     'ssh_opts', # Additional options for ssh commands.
     'key_name',  # The EC2 keypair name.
     'security_group',  # AWS security group (which must allow SSH).
     'ec2_type',  # EC2 instance type to create.
     'user',  # SSH username.
-    'scripts',  # Scripts for `run`, and a special `setup` script.
+    'scripts',  # Scripts (as bytes) for `run`, and a special `setup` one.
 ])
 
 
+class Config(_Config):
+    __slots__ = ()
+
+    @property
+    def ec2(self):
+        """The Boto EC2 client, created on first use.
+        """
+        return make_ec2(self.region)
+
+
 class State(enum.IntEnum):
     """The EC2 instance state codes.
     """
@@ -57,57 +122,241 @@ class State(enum.IntEnum):
     STOPPED = 80
 
 
+# The names of states for instances that have not been terminated.
+LIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# EC2 error codes for state changes that concern a specific instance,
+# rather than the request as a whole. See `change_states`.
+INSTANCE_ERRORS = {
+    'IncorrectInstanceState',
+    'InvalidInstanceID.Malformed',
+    'InvalidInstanceID.NotFound',
+    'OperationNotPermitted',
+    'UnsupportedOperation',
+}
+
+
 def fmt_cmd(cmd):
     """Format a shell command, given as a list of arguments a single
     copy-n-pastable string.
     """
-    return ' '.join(shlex.quote(s) for s in cmd)
+    return shlex.join(cmd)
+
+
+def run_cmd(cmd, level=logging.INFO, **kwargs):
+    """Log a command (given as a list of arguments) at `level` and then
+    run it. Extra keyword arguments go to `subprocess.run`.
+    """
+    if log.isEnabledFor(level):
+        log.log(level, fmt_cmd(cmd))
+    return subprocess.run(cmd, **kwargs)
+
+
+def run_prefixed(cmd, input, prefix, level=logging.INFO):
+    """Log and run a command, feeding it `input` (as bytes). Print each
+    line of its output (stdout and stderr together) after a `[prefix]`
+    tag as soon as it arrives, and return the exit status.
+    """
+    if log.isEnabledFor(level):
+        log.log(level, fmt_cmd(cmd))
+
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT) as proc:
+        # Feed the input from another thread so that neither pipe can
+        # fill up and stall the other.
+        def feed():
+            try:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            except OSError:
+                pass  # The command exited without reading everything.
+
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+        for line in proc.stdout:
+            click.echo('[{}] {}'.format(
+                prefix, line.decode(errors='replace').rstrip('\r\n'),
+            ))
+        writer.join()
+    return proc.returncode
+
+
+def exec_cmd(cmd, env=None, level=logging.INFO):
+    """Log a command and replace the current process with it, so we do
+    not keep an idle Python process around for the likes of interactive
+    sessions. Use this only as the last thing a command does.
+
+    On systems without `exec`, just run the command and wait for it.
+    """
+    if log.isEnabledFor(level):
+        log.log(level, fmt_cmd(cmd))
+    if os.name != 'posix':
+        subprocess.run(cmd, env=env)
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if env is None:
+        os.execvp(cmd[0], cmd)
+    else:
+        os.execvpe(cmd[0], cmd, env)
 
 
-def test_connect(host, port, timeout=2):
+def test_connect(host, port, timeout=1):
     """Try connecting to `host` on `port`. Return a bool indicating
     whether the connection was successful, i.e., someone is listening on
     that port.
+
+    Like `socket.create_connection`, we try each address the host
+    resolves to in turn. Each connection is made without blocking, and we
+    wait for up to `timeout` seconds for its handshake to finish.
+    Successful address lookups are cached, so repeated probes skip DNS.
     """
     try:
-        sock = socket.create_connection((host, port), timeout)
-    except ConnectionRefusedError:
-        log.debug('connection refused')
+        if (host, port) not in _addr_cache:
+            _addr_cache[host, port] = socket.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM,
+            )
+    except OSError as exc:
+        # DNS failures are common while an instance boots.
+        log.debug('connection failed: {}'.format(exc))
         return False
-    except socket.timeout:
-        log.debug('connection timeout')
+
+    return any(connect_addr(info, timeout) for info in _addr_cache[host, port])
+
+
+def connect_addr(info, timeout):
+    """Try connecting to one address, given as a `getaddrinfo` entry.
+    Return a bool indicating whether the connection was successful.
+    """
+    family, kind, proto, _, addr = info
+    try:
+        sock = socket.socket(family, kind, proto)
+    except OSError as exc:
+        log.debug('connection failed: {}'.format(exc))
+        return False
+
+    with sock, selectors.DefaultSelector() as sel:
+        sock.setblocking(False)
+        err = sock.connect_ex(addr)
+        if err in CONNECT_PENDING:
+            # Wait for the socket to become writable, which signals that
+            # the handshake either completed or failed.
+            sel.register(sock, selectors.EVENT_WRITE)
+            if not sel.select(timeout):
+                log.debug('connection to {} timed out'.format(addr[0]))
+                return False
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+    if err == errno.ECONNREFUSED:
+        log.debug('connection to {} refused'.format(addr[0]))
+        return False
+    elif err:
+        log.debug('connection to {} failed: {}'.format(
+            addr[0], os.strerror(err),
+        ))
         return False
     else:
-        sock.close()
         return True
 
 
-def host_wait(host, port, interval=10):
-    """Wait until `host` starts accepting connections on `port` by
-    attempting to connect every `interval` seconds.
+def host_wait(host, port, base=0.5, cap=10.0, jitter=0.5, timeout=600.0):
+    """Wait until `host` starts accepting connections on `port`.
+
+    Between attempts, back off exponentially: the base delay starts at
+    `base` seconds and doubles up to at most `cap` seconds. Jitter is
+    applied on top of that, scaling each delay by a random factor of up
+    to `jitter` in either direction, so sleeps can reach
+    `cap * (1 + jitter)`. The jitter keeps several clients waiting on the
+    same host from probing in lockstep. Each attempt's connection timeout
+    grows along with the delay (from at least 1 second), so slow hosts
+    get more patient probes.
+
+    Give up with a `click.ClickException` after `timeout` seconds in
+    total (e.g., when a security group blocks the port).
     """
-    while not test_connect(host, port):
-        log.debug('{} not yet up on port {}'.format(host, port))
-        time.sleep(interval)
+    deadline = time.monotonic() + timeout
+    backoff = base
+    while not test_connect(host, port, timeout=max(1.0, backoff)):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise click.ClickException(
+                '{} did not accept connections on port {} within {:.0f}s'
+                .format(host, port, timeout)
+            )
+        delay = min(remaining, backoff * (1 + random.uniform(-jitter, jitter)))
+        log.debug('{} not yet up on port {}; retrying in {:.1f}s'.format(
+            host, port, delay,
+        ))
+        time.sleep(delay)
+        backoff = min(cap, backoff * 2)
+
+
+def slim_instance(inst):
+    """Copy just the `INSTANCE_FIELDS` of an EC2 instance description.
+    """
+    return {k: inst[k] for k in INSTANCE_FIELDS if k in inst}
+
+
+def describe_instances(ec2, filters=()):
+    """Get a list of the EC2 instances matching the server-side
+    `filters`, fetching every page of results.
+
+    Results are cached for `CACHE_TTL` seconds, keyed by the client and
+    the filters. Call `forget_instances` after changing the state of any
+    instance.
+    """
+    key = (id(ec2), repr(filters))
+    cached = _instance_cache.get(key)
+    if cached and time.monotonic() - cached[0] < CACHE_TTL:
+        return cached[1]
+
+    paginator = ec2.get_paginator('describe_instances')
+    insts = []
+    for page in paginator.paginate(Filters=list(filters)):
+        for res in page['Reservations']:
+            insts.extend(slim_instance(inst) for inst in res['Instances'])
+    _instance_cache[key] = (time.monotonic(), insts)
+    return insts
+
+
+def forget_instances():
+    """Clear the cache of instance descriptions.
+    """
+    _instance_cache.clear()
 
 
-def all_instances(ec2):
-    """Generate all the currently available EC2 instances.
+def all_instances(ec2, filters=()):
+    """Generate all the currently available EC2 instances, optionally
+    restricted by server-side `filters`.
     """
-    r = ec2.describe_instances()
-    for res in r['Reservations']:
-        for inst in res['Instances']:
-            yield inst
+    yield from describe_instances(ec2, filters)
 
 
-def get_instances(config):
+def get_instances(config, states=None):
     """Generate the current EC2 instances that are either based on any
     of the configured AMIs or have matadata names.
+
+    If `states` is a list of state names (e.g., `'running'`), only get
+    instances in those states.
     """
-    for inst in all_instances(config.ec2):
-        if inst['ImageId'] in config.ami_ids.values() or \
-                get_instance_name(inst):
-            yield inst
+    state_filters = ()
+    if states is not None:
+        state_filters = ({'Name': 'instance-state-name', 'Values': states},)
+
+    # EC2 filters can only be conjoined, so we issue one query for each
+    # case and merge the results.
+    ami_ids = sorted(set(config.ami_ids.values()))
+    queries = [
+        ({'Name': 'image-id', 'Values': ami_ids},) + state_filters,
+        ({'Name': 'tag-key', 'Values': ['Name']},) + state_filters,
+    ]
+    seen = set()
+    for filters in queries:
+        for inst in all_instances(config.ec2, filters):
+            if inst['InstanceId'] not in seen:
+                seen.add(inst['InstanceId'])
+                yield inst
 
 
 def get_instance_name(inst):
@@ -125,33 +374,113 @@ def get_instance_name(inst):
 def get_instance(ec2, instance_id):
     """Look up an EC2 instance by its id.
     """
-    r = ec2.describe_instances(InstanceIds=[instance_id])
-    return r['Reservations'][0]['Instances'][0]
+    filters = ({'Name': 'instance-id', 'Values': [instance_id]},)
+    return describe_instances(ec2, filters)[0]
+
+
+def get_states(ec2, instance_ids):
+    """Get a dict mapping each of a list of instance IDs to its current
+    state code.
+
+    This uses `DescribeInstanceStatus`, whose responses are much smaller
+    than `DescribeInstances` when the state is all we need.
+    """
+    paginator = ec2.get_paginator('describe_instance_status')
+    pages = paginator.paginate(
+        InstanceIds=list(instance_ids),
+        IncludeAllInstances=True,
+    )
+    return {
+        status['InstanceId']: status['InstanceState']['Code']
+        for page in pages
+        for status in page['InstanceStatuses']
+    }
 
 
 def get_default_instance(config):
     """Return *some* existing EC2 instance for the *default* image, if
     one exists. Otherwise, return None.
+
+    Running instances are preferred, then pending ones, then stopped
+    ones, to avoid waiting for an instance to boot if we can.
     """
-    for inst in get_instances(config):
-        if inst['ImageId'] != config.ami_ids[config.ami_default]:
-            # Only consider the default image.
-            continue
-        if inst['State']['Code'] in (State.TERMINATED, State.SHUTTING_DOWN):
-            # Ignore terminated instances.
-            continue
-        return inst
-    return None
+    if not config.ami_default:
+        return None
+
+    # Only consider the default image, and ignore terminated instances.
+    filters = (
+        {'Name': 'image-id', 'Values': [config.ami_ids[config.ami_default]]},
+        {'Name': 'instance-state-name', 'Values': LIVE_STATES},
+    )
+
+    # Prefer instances that will be usable soonest.
+    preference = ['running', 'pending', 'stopped', 'stopping']
+    insts = sorted(
+        all_instances(config.ec2, filters),
+        key=lambda inst: preference.index(inst['State']['Name']),
+    )
+    return insts[0] if insts else None
 
 
-def instance_wait(ec2, instance_id, until='instance_running'):
-    """Wait for an EC2 instance to transition into a given state.
+def instance_wait(ec2, instance_ids, until='instance_running',
+                  delay=5, max_attempts=60):
+    """Wait for a list of EC2 instances to transition into a given state.
 
     Possibilities for `until` include `'instance_running'` and
-    `'instance_stopped'`.
+    `'instance_stopped'`. The waiter polls all the instances together
+    every `delay` seconds, giving up after `max_attempts` polls.
     """
     waiter = ec2.get_waiter(until)
-    waiter.wait(InstanceIds=[instance_id])
+    waiter.wait(
+        InstanceIds=list(instance_ids),
+        WaiterConfig={'Delay': delay, 'MaxAttempts': max_attempts},
+    )
+
+
+def change_states(ec2, method, instance_ids, max_workers=8):
+    """Apply an EC2 state-changing API `method` (e.g., `'stop_instances'`)
+    to a list of instances. Return a list of the IDs it succeeded for and
+    a dict mapping the IDs it failed for to their error messages.
+
+    All the instances go in a single request. If EC2 rejects that batch
+    because of a problem with a specific instance, fall back to one
+    request per instance, issued concurrently, so that one bad instance
+    does not prevent acting on the rest. Other errors (e.g., missing
+    permissions) would fail for every instance anyway, so they are
+    raised as a `click.ClickException`.
+    """
+    import botocore.exceptions
+
+    func = getattr(ec2, method)
+    try:
+        func(InstanceIds=list(instance_ids))
+        return list(instance_ids), {}
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] not in INSTANCE_ERRORS:
+            raise click.ClickException('{} failed: {}'.format(method, exc))
+        if len(instance_ids) <= 1:
+            failed = {iid: str(exc) for iid in instance_ids}
+            for iid, err in failed.items():
+                log.error('{} failed for {}: {}'.format(method, iid, err))
+            return [], failed
+        log.debug('batched {} failed: {}'.format(method, exc))
+
+    done = []
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        futures = {
+            pool.submit(func, InstanceIds=[iid]): iid for iid in instance_ids
+        }
+        for future in concurrent.futures.as_completed(futures):
+            iid = futures[future]
+            if future.exception():
+                failed[iid] = str(future.exception())
+                log.error('{} failed for {}: {}'.format(
+                    method, iid, failed[iid],
+                ))
+            else:
+                done.append(iid)
+    return done, failed
 
 
 def create_instance(config):
@@ -169,18 +498,127 @@ def create_instance(config):
         KeyName=config.key_name,
         SecurityGroups=[config.security_group],
     )
+    forget_instances()
     assert len(res['Instances']) == 1
     return res['Instances'][0]
 
 
+def is_instance_id(name):
+    """Check whether `name` looks like an EC2 instance ID.
+    """
+    return bool(INSTANCE_ID_RE.fullmatch(name))
+
+
 def get_named_instance(ec2, name):
     """Get an instance with the metadata name `name`, or None if no such
-    named instance exists.
+    named instance exists. `name` may also be an instance ID.
+
+    Terminated instances are ignored, since their names may since have
+    been reused.
     """
-    for inst in all_instances(ec2):
-        if get_instance_name(inst) == name:
-            return inst
-    return None
+    key = 'instance-id' if is_instance_id(name) else 'tag:Name'
+    filters = (
+        {'Name': key, 'Values': [name]},
+        {'Name': 'instance-state-name', 'Values': LIVE_STATES},
+    )
+    return next(all_instances(ec2, filters), None)
+
+
+def load_state():
+    """Load the saved state from earlier invocations, which maps lookup
+    keys to recently used running instances.
+    """
+    try:
+        with open(STATE_PATH) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save_state(state):
+    """Save the state for later invocations. Failures are not fatal.
+
+    The state is written to a temporary file that then replaces the old
+    one, so concurrent readers never see a partially written file.
+    """
+    state_dir = os.path.dirname(STATE_PATH)
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=state_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, STATE_PATH)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError as exc:
+        log.debug('could not save state: {}'.format(exc))
+
+
+def clear_state():
+    """Remove the saved state, if there is any.
+    """
+    try:
+        os.remove(STATE_PATH)
+    except FileNotFoundError:
+        pass
+
+
+def get_saved_instance(config, key):
+    """Get a recently used instance saved under `key`, if it is fresh
+    enough and still running. Otherwise, return None.
+
+    Checking the state is cheaper than looking the instance up again,
+    and its hostname does not change while it keeps running.
+    """
+    import botocore.exceptions
+
+    saved = load_state().get(key)
+    try:
+        age = time.time() - saved['time']
+        inst = saved['instance']
+        iid = inst['InstanceId']
+        host = inst['PublicDnsName']
+    except (KeyError, TypeError):
+        # Nothing saved, or saved in a shape we don't understand.
+        return None
+    if age > STATE_TTL or not host:
+        return None
+
+    try:
+        states = get_states(config.ec2, [iid])
+    except botocore.exceptions.ClientError:
+        return None
+    if states.get(iid) != State.RUNNING:
+        return None
+
+    log.info('using recent instance {}'.format(iid))
+    return inst
+
+
+def save_instance(key, inst):
+    """Save a running instance under `key` for later invocations.
+
+    The load and save are done under a lock, so concurrent threads (as
+    in a multi-instance `run`) do not lose each other's entries. Entries
+    older than `STATE_TTL` are dropped, since they would be ignored.
+    """
+    now = time.time()
+    with _state_lock:
+        state = {}
+        for k, saved in load_state().items():
+            try:
+                if now - saved['time'] <= STATE_TTL:
+                    state[k] = saved
+            except (KeyError, TypeError):
+                pass  # Drop entries we don't understand.
+        state[key] = {
+            'time': now,
+            'instance': slim_instance(inst),
+        }
+        save_state(state)
 
 
 def get_running_instance(config, name):
@@ -190,6 +628,28 @@ def get_running_instance(config, name):
     If `name` is specified, get the instance with that name, or throw a
     `click.UserError` if it does not exist. Otherwise, look for any
     instance with the default AMI.
+
+    Running instances are remembered for `STATE_TTL` seconds, so a
+    quick succession of commands can skip looking them up.
+    """
+    if name:
+        key = 'name:{}'.format(name)
+    elif config.ami_default:
+        key = 'image:{}'.format(config.ami_ids[config.ami_default])
+    else:
+        key = None
+
+    inst = key and get_saved_instance(config, key)
+    if not inst:
+        inst = start_instance(config, name)
+        if key:
+            save_instance(key, inst)
+    return inst
+
+
+def start_instance(config, name):
+    """Find an instance, as in `get_running_instance`, and make sure it
+    is running. Create a new one if none exists.
     """
     if name:
         inst = get_named_instance(config.ec2, name)
@@ -198,6 +658,10 @@ def get_running_instance(config, name):
     else:
         inst = get_default_instance(config)
 
+    # Restarting an existing instance is quick, so we can poll often. A
+    # new instance takes much longer to boot, so we poll less often.
+    delay, max_attempts = 3, 200
+
     if inst:
         iid = inst['InstanceId']
         log.info('found existing instance {}'.format(iid))
@@ -209,18 +673,8 @@ def get_running_instance(config, name):
             log.info('instance is stopped; starting')
             config.ec2.start_instances(InstanceIds=[iid])
 
-            log.info('waiting for instance to start')
-            instance_wait(config.ec2, iid)
-
-            # "Refresh" the instance so we have its hostname.
-            return get_instance(config.ec2, iid)
-
         elif inst['State']['Code'] == State.PENDING:
-            log.info('instance is pending; waiting for instance to start')
-            instance_wait(config.ec2, iid)
-
-            # "Refresh" the instance so we have its hostname.
-            return get_instance(config.ec2, iid)
+            log.info('instance is pending')
 
         else:
             raise NotImplementedError(
@@ -229,12 +683,30 @@ def get_running_instance(config, name):
 
     else:
         log.info('no existing instance; creating a new one')
-        inst = create_instance(config)
+        iid = create_instance(config)['InstanceId']
+        delay, max_attempts = 15, 40
+
+    log.info('waiting for instance to start')
+    instance_wait(config.ec2, [iid], delay=delay, max_attempts=max_attempts)
+    forget_instances()
+
+    # "Refresh" the instance so we have its hostname.
+    return get_instance(config.ec2, iid)
 
-        log.info('waiting for new instance to start')
-        instance_wait(config.ec2, inst['InstanceId'])
 
-        return get_instance(config.ec2, inst['InstanceId'])
+def wait_ready(inst):
+    """Wait until an EC2 instance accepts SSH connections and return its
+    hostname.
+    """
+    host = inst['PublicDnsName']
+    if not host:
+        raise click.ClickException(
+            'Instance {} has no public hostname.'.format(inst['InstanceId'])
+        )
+
+    # Wait for the host to start its SSH server.
+    host_wait(host, SSH_PORT)
+    return host
 
 
 def ssh_host(config, host):
@@ -242,50 +714,169 @@ def ssh_host(config, host):
     return '{}@{}'.format(config.user, host)
 
 
-def ssh_command(config, host):
-    """Construct a command for SSHing into an EC2 instance.
+def ssh_args(config):
+    """Get the `ssh` invocation, without a destination, that all our SSH
+    connections use.
+
+    For `-o` options, ssh uses the first value it sees, so the user's
+    `ssh_opts` come before our `SSH_OPTS` in order to override them.
     """
     return [
         'ssh',
         '-i', config.ssh_key,
         *config.ssh_opts,
-        ssh_host(config, host),
+        *SSH_OPTS,
     ]
 
 
-def run_script(config, host, scriptname):
+def ssh_command(config, host):
+    """Construct a command for SSHing into an EC2 instance.
+    """
+    return ssh_args(config) + [ssh_host(config, host)]
+
+
+def once_per_boot(script):
+    """Wrap a shell script (as bytes) so that it only does anything the
+    first time it runs successfully on a given boot of a host.
+
+    A marker file records the script's hash and the kernel's boot ID, so
+    the script runs again if it changes or the instance reboots (e.g.,
+    to reload the FPGA after a stop and start).
+    """
+    digest = hashlib.sha256(script).hexdigest()[:16]
+    header = (
+        'marker="{digest} $(cat /proc/sys/kernel/random/boot_id)"\n'
+        'if [ "$(cat {path} 2>/dev/null)" = "$marker" ]; then\n'
+        '  echo "Already set up."\n'
+        '  exit 0\n'
+        'fi\n'
+        '(\n'
+    ).format(digest=digest, path=SETUP_MARKER)
+    footer = '\n) && echo "$marker" > {}\n'.format(SETUP_MARKER)
+    return header.encode() + script + footer.encode()
+
+
+def run_script(config, host, scriptname, once=False, prefix=None,
+               check=False):
     """Run a script from config on host.
+
+    With `once`, skip the script if it has already run on the host since
+    it last booted. With `prefix`, print each line of the script's output
+    after a `[prefix]` tag as it arrives, so output from several hosts can
+    be told apart. If the script fails, raise an error when `check` is
+    set, and otherwise just warn.
     """
     if scriptname not in config.scripts:
         raise click.UsageError('Script "{}" not found.'.format(scriptname))
 
     log.info('running script {}'.format(scriptname))
+    script = config.scripts[scriptname]
+    if once:
+        script = once_per_boot(script)
     sh_cmd = ssh_command(config, host) + ['sh']
-    log.debug(fmt_cmd(sh_cmd))
-    subprocess.run(sh_cmd, input=config.scripts[scriptname].encode())
+    if prefix is None:
+        status = run_cmd(sh_cmd, logging.DEBUG, input=script).returncode
+    else:
+        status = run_prefixed(sh_cmd, script, prefix, logging.DEBUG)
+
+    if status:
+        msg = 'script {} failed with status {}'.format(scriptname, status)
+        if prefix is not None:
+            msg = '[{}] {}'.format(prefix, msg)
+        if check:
+            raise click.ClickException(msg)
+        log.warning(msg)
+
+
+def run_scripts(config, name, scripts, prefix=None):
+    """Get a running instance, run the setup script on it (if needed)
+    and then each of `scripts` in order, stopping if any of them fails.
+    Return the host.
+    """
+    inst = get_running_instance(config, name)
+    host = wait_ready(inst)
+
+    # Always run the setup script. The scripts may depend on it, so we
+    # stop at the first failure. When `setup` is one of the scripts, the
+    # user wants to force it to run again, so we don't run it twice.
+    if 'setup' not in scripts:
+        run_script(config, host, 'setup', once=True, prefix=prefix,
+                   check=True)
+
+    for script in scripts:
+        run_script(config, host, script, prefix=prefix, check=True)
+
+    return host
 
 
 def fmt_inst(config, inst):
     """Format an EC2 instance object as a string for display.
     """
-    ami_names = {v: k for (k, v) in config.ami_ids.items()}
     return '{} ({}): {}'.format(
         get_instance_name(inst) or inst['InstanceId'],
         inst['State']['Name'],
-        ami_names.get(inst['ImageId'], inst['ImageId']),
+        config.ami_names.get(inst['ImageId'], inst['ImageId']),
     )
 
 
+def make_ec2(region):
+    """Get a Boto EC2 client for `region`.
+
+    Creating a client loads and parses botocore's service model, so we
+    make one client per region and reuse it. The first use can come from
+    worker threads (as in a multi-instance `run`), and creating clients
+    on boto3's shared default session is not thread-safe, so creation
+    happens under a lock.
+    """
+    with _ec2_lock:
+        if region not in _ec2_clients:
+            # boto3 is slow to import, so we only load it once we know we
+            # are running a command (and not, for example, just printing
+            # help).
+            import boto3
+            import botocore.config
+
+            # Retry throttled requests with adaptive client-side rate
+            # limiting, and keep pooled HTTPS connections alive between
+            # calls.
+            _ec2_clients[region] = boto3.client(
+                'ec2',
+                region_name=region,
+                config=botocore.config.Config(
+                    retries={'mode': 'adaptive', 'max_attempts': 10},
+                    max_pool_connections=25,
+                    tcp_keepalive=True,
+                ),
+            )
+        return _ec2_clients[region]
+
+
 def load_config():
     """Load the configuration object by merging the default options with
     the user configuration file.
+
+    Tables (like `ami_ids` and `scripts`) are merged key by key, so the
+    user file only needs to list the entries it adds or overrides.
     """
-    with open(DEFAULT_PATH) as f:
-        config = tomlkit.loads(f.read())
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+
+    with open(DEFAULT_PATH, 'rb') as f:
+        config = tomllib.load(f)
 
-    if os.path.isfile(CONFIG_PATH):
-        with open(CONFIG_PATH) as f:
-            config.update(tomlkit.loads(f.read()))
+    try:
+        with open(CONFIG_PATH, 'rb') as f:
+            user_config = tomllib.load(f)
+    except FileNotFoundError:
+        user_config = {}
+
+    for key, value in user_config.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key].update(value)
+        else:
+            config[key] = value
 
     return config
 
@@ -309,6 +900,16 @@ def chazz(ctx, verbose, ami, image, user):
     # Load the configuration from the user's config file & defaults.
     config_opts = load_config()
 
+    # ssh cannot create the directory for its control sockets itself.
+    # Without it, ssh just connects without multiplexing.
+    try:
+        os.makedirs(
+            os.path.dirname(os.path.expanduser(SSH_CONTROL_PATH)),
+            mode=0o700, exist_ok=True,
+        )
+    except OSError as exc:
+        log.debug('could not create control socket directory: {}'.format(exc))
+
     # Options to choose specific images. The image (i.e.,
     # `config.ami_default`) is necessary to support instance *creation*;
     # when it's None, we can only interact with existing instances.
@@ -323,19 +924,18 @@ def chazz(ctx, verbose, ami, image, user):
             image,
         ))
 
-    ec2 = boto3.client('ec2', region_name=config_opts['aws_region'])
-
     ctx.obj = Config(
-        ec2=ec2,
+        region=config_opts['aws_region'],
         ami_ids=ami_ids,
+        ami_names={v: k for (k, v) in ami_ids.items()},
         ami_default=image,
-        ssh_key=os.path.expanduser(config_opts['ssh_key']),
+        ssh_key=os.path.abspath(os.path.expanduser(config_opts['ssh_key'])),
         ssh_opts=config_opts['ssh_opts'],
         key_name=config_opts['key_name'],
         security_group=config_opts['security_group'],
         ec2_type=config_opts['ec2_type'],
         user=user or config_opts['user'],
-        scripts=config_opts['scripts'],
+        scripts={k: v.encode() for (k, v) in config_opts['scripts'].items()},
     )
     log.debug('%s', ctx.obj)
 
@@ -346,29 +946,50 @@ def chazz(ctx, verbose, ami, image, user):
 @click.argument('scripts', nargs=-1, metavar='[SCRIPTS]')
 @click.option('--no-exit', '-N', is_flag=True, default=False,
               help="Don't exit instance after running scripts.")
-def run(config, name, scripts, no_exit):
+@click.option('--max-concurrency', '-j', default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help='Most instances to run scripts on at once.')
+def run(config, name, scripts, no_exit, max_concurrency):
     """Run configured scripts on an instance.
 
     SCRIPTS are the names of shell scripts from the configuration file.
     Multiple scripts are run in the order specified.
-    """
-    inst = get_running_instance(config, name)
-    host = inst['PublicDnsName']
 
-    # Wait for the host to start its SSH server.
-    host_wait(host, SSH_PORT)
-
-    # Always run the setup script
-    run_script(config, host, 'setup')
+    INSTANCE may also be a comma-separated list of names or IDs, in which
+    case the scripts run on up to --max-concurrency of those instances at
+    once and each line of output is tagged with its instance.
+    """
+    names = [n for n in dict.fromkeys(name.split(',')) if n] if name else []
+    if len(names) <= 1:
+        host = run_scripts(config, names[0] if names else None, scripts)
 
-    for script in scripts:
-        run_script(config, host, script)
+        # Run the interactive SSH command.
+        if no_exit:
+            exec_cmd(ssh_command(config, host))
+        return
 
-    # Run the interactive SSH command.
     if no_exit:
-        cmd = ssh_command(config, host)
-        log.info(fmt_cmd(cmd))
-        subprocess.run(cmd)
+        raise click.UsageError('--no-exit needs a single instance.')
+    workers = min(len(names), max_concurrency)
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(run_scripts, config, n, scripts, prefix=n): n
+                   for n in names}
+
+    # Report every instance that failed, not just the first.
+    failed = []
+    for future, n in futures.items():
+        exc = future.exception()
+        if exc is None:
+            continue
+        if not isinstance(exc, click.ClickException):
+            raise exc
+        msg = exc.format_message()
+        if not msg.startswith('[{}]'.format(n)):
+            msg = '[{}] {}'.format(n, msg)
+        log.error(msg)
+        failed.append(n)
+    if failed:
+        raise click.ClickException('failed on {}'.format(', '.join(failed)))
 
 
 @chazz.command()
@@ -382,18 +1003,13 @@ def ssh(config, name):
     one if no instance is running.
     """
     inst = get_running_instance(config, name)
-    host = inst['PublicDnsName']
-
-    # Wait for the host to start its SSH server.
-    host_wait(host, SSH_PORT)
+    host = wait_ready(inst)
 
     # Set up the VM.
-    run_script(config, host, 'setup')
+    run_script(config, host, 'setup', once=True)
 
     # Run the interactive SSH command.
-    cmd = ssh_command(config, host)
-    log.info(fmt_cmd(cmd))
-    subprocess.run(cmd)
+    exec_cmd(ssh_command(config, host))
 
 
 @chazz.command()
@@ -410,12 +1026,12 @@ def shell(config, name, cmd):
         'ssh-agent', 'sh', '-c',
         'ssh-add "$HB_KEY" ; {}'.format(cmd),
     ]
-    subprocess.run(cmd, env={
+    exec_cmd(cmd, env={
         **os.environ,
         'HB': ssh_host(config, host),
         'HB_HOST': host,
-        'HB_KEY': os.path.abspath(config.ssh_key),
-    })
+        'HB_KEY': config.ssh_key,
+    }, level=logging.DEBUG)
 
 
 @chazz.command()
@@ -429,17 +1045,16 @@ def start(config, names):
         print(fmt_inst(config, inst))
 
 
-@chazz.command()
+@chazz.command(name='list')
 @click.pass_obj
-def list(config):
+def list_instances(config):
     """Show the available instances.
 
     The list includes all instances that either use one of the
     configured AMIs or has a metadata tag "Name".
     """
-    all_insts = sorted([ fmt_inst(config, inst) for inst in get_instances(config) ])
-    for inst in all_insts:
-        print(inst)
+    all_insts = sorted(fmt_inst(config, inst) for inst in get_instances(config))
+    sys.stdout.writelines(inst + '\n' for inst in all_insts)
 
 
 @chazz.command()
@@ -454,36 +1069,74 @@ def list(config):
 def stop(config, names, wait, terminate, all):
     """Stop all running instances, or one given by its name or ID.
     """
-    # If `name` is specified, it can either be a name or an ID.
-    stop_ids = set()
-    for name in names:
-        inst = get_named_instance(config.ec2, name)
-        if inst:
-            stop_ids.add(inst['InstanceId'])
-        else:
-            stop_ids.add(name)
+    # Each of `names` can either be a name or an ID. Look up all the names
+    # in one request.
+    named = {}
+    tags = sorted({name for name in names if not is_instance_id(name)})
+    if tags:
+        filters = (
+            {'Name': 'tag:Name', 'Values': tags},
+            {'Name': 'instance-state-name', 'Values': LIVE_STATES},
+        )
+        for inst in all_instances(config.ec2, filters):
+            named.setdefault(get_instance_name(inst), inst['InstanceId'])
+    for name in tags:
+        if name not in named:
+            raise click.UsageError('Instance {} not found.'.format(name))
+    stop_ids = {named.get(name, name) for name in names}
 
     if not stop_ids and not all:
         log.info('Stop invoked without instance id. Use flag --all if intended to stop all machines')
         return
 
-    for inst in get_instances(config):
-        iid = inst['InstanceId']
-        if stop_ids and iid not in stop_ids:
-            continue
+    # Find the current states of the candidate instances. For specific
+    # instances, we only need their states, not full descriptions.
+    if stop_ids:
+        import botocore.exceptions
+        try:
+            states = get_states(config.ec2, sorted(stop_ids))
+        except botocore.exceptions.ClientError as exc:
+            raise click.UsageError(str(exc))
+    else:
+        if terminate:
+            wanted = LIVE_STATES
+        else:
+            wanted = ['running']
+        states = {inst['InstanceId']: inst['State']['Code']
+                  for inst in get_instances(config, wanted)}
 
+    # Collect the affected instances so we can act on them in one call.
+    iids = []
+    for iid, state in states.items():
         if terminate:
-            if inst['State']['Code'] != State.TERMINATED:
-                log.info('terminating {}'.format(iid))
-                config.ec2.terminate_instances(InstanceIds=[iid])
-                if wait:
-                    instance_wait(config.ec2, iid, 'instance_terminated')
+            if state != State.TERMINATED:
+                iids.append(iid)
         else:
-            if inst['State']['Code'] == State.RUNNING:
-                log.info('stopping {}'.format(iid))
-                config.ec2.stop_instances(InstanceIds=[iid])
-                if wait:
-                    instance_wait(config.ec2, iid, 'instance_stopped')
+            if state == State.RUNNING:
+                iids.append(iid)
+
+    if not iids:
+        return
+
+    if terminate:
+        log.info('terminating {}'.format(', '.join(iids)))
+        iids, failed = change_states(config.ec2, 'terminate_instances', iids)
+    else:
+        log.info('stopping {}'.format(', '.join(iids)))
+        iids, failed = change_states(config.ec2, 'stop_instances', iids)
+    forget_instances()
+
+    if wait and iids:
+        # Stopping can take longer than starting, so allow up to 10
+        # minutes rather than the default of 5.
+        until = 'instance_terminated' if terminate else 'instance_stopped'
+        instance_wait(config.ec2, iids, until, max_attempts=120)
+
+    if failed:
+        raise click.ClickException('could not {} {}'.format(
+            'terminate' if terminate else 'stop',
+            ', '.join(sorted(failed)),
+        ))
 
 
 @chazz.command()
@@ -493,19 +1146,28 @@ def stop(config, names, wait, terminate, all):
 @click.argument('name', required=False, metavar='[INSTANCE]')
 @click.option('--watch', '-w', is_flag=True, default=False,
               help='Use entr to wait for changes and automatically sync.')
-def sync(config, src, dest, name, watch):
+@click.option('--checksum/--no-checksum', default=False,
+              help='Compare file contents, not just sizes and times.')
+@click.option('--compress/--no-compress', default=True,
+              help='Compress data in transit (the default).')
+def sync(config, src, dest, name, watch, checksum, compress):
     """Synchronize files with an instance.
+
+    By default, files are skipped when their size and modification time
+    match. Use --checksum to compare their contents instead, which
+    requires reading every file on both ends.
     """
     # Get a connectable host.
     inst = get_running_instance(config, name)
-    host = inst['PublicDnsName']
-    host_wait(host, SSH_PORT)
+    host = wait_ready(inst)
 
     # Concoct the rsync command.
     rsync_cmd = [
-        'rsync', '--checksum', '--itemize-changes', '--recursive',
-        '--copy-links',
-        '-e', 'ssh -i {}'.format(shlex.quote(config.ssh_key)),
+        'rsync', '--itemize-changes', '--recursive', '--copy-links',
+        '--times', '--inplace',
+        *(['--checksum'] if checksum else []),
+        *(['--compress'] if compress else []),
+        '-e', fmt_cmd(ssh_args(config)),
         os.path.normpath(src),
         '{}:{}'.format(ssh_host(config, host), os.path.normpath(dest)),
     ]
@@ -513,13 +1175,27 @@ def sync(config, src, dest, name, watch):
     if watch:
         # Use `watchexec` to watch for changes.
         we_cmd = ['watchexec', '-w', src, '-n', '--'] + rsync_cmd
-        log.info(fmt_cmd(we_cmd))
-        subprocess.run(we_cmd)
+        run_cmd(we_cmd)
 
     else:
         # Just rsync once.
-        log.info(fmt_cmd(rsync_cmd))
-        subprocess.run(rsync_cmd)
+        run_cmd(rsync_cmd)
+
+
+@chazz.group()
+def cache():
+    """Manage the saved instance lookups.
+    """
+
+
+@cache.command()
+def clear():
+    """Forget recently used instances.
+
+    Chazz remembers the instances it recently connected to for a minute,
+    so that consecutive commands can skip looking them up again.
+    """
+    clear_state()
 
 
 if __name__ == '__main__':